@@ -3,6 +3,7 @@ import numpy as np
 from progress.bar import Bar
 import argparse
 import cpa_utils
+import cpa_profile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--traces", help="Path to traces", required=True)
@@ -12,7 +13,9 @@ parser.add_argument("--count", help="Number of sample to use", type=int, default
 parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
 parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
 parser.add_argument("--note", help="Add a note to plots", default="")
+cpa_profile.add_argument(parser)
 args = parser.parse_args()
+cpa_profile.setup(args)
 
 start_point_for_align = args.sa
 end_point_for_align   = args.ea
@@ -20,14 +23,18 @@ num_traces            = args.num
 sample_start          = args.start
 sample_count          = args.count
 
+cpa_profile.start("load")
 cyphers, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
 
 num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("align")
 print("Align traces...")
 
 reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
 aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
 
 del traces
 
@@ -37,6 +44,7 @@ cpaoutput = [0]*BNUM
 
 with Bar("Plotting CPA", max=BNUM) as bar:
     for bnum in range(0, BNUM):
+        cpa_profile.start("cpa")
 
         sumnum = np.zeros(num_samples)
         sumden1 = np.zeros(num_samples)
@@ -63,20 +71,25 @@ with Bar("Plotting CPA", max=BNUM) as bar:
             sumden2 = sumden2 + tdiff*tdiff
 
         cpaoutput[bnum] = (sumnum / np.sqrt(sumden1*sumden2))
+        cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
 
+        cpa_profile.start("plot")
         plt.figure(figsize=(20, 5))
         plt.plot(cpaoutput[bnum], color="grey", zorder=1)
         plt.axvline(x=5000, color="blue", lw=3, zorder=2, label="AES-decrypt, Start")
         plt.title(f"{num_traces} traces, CPA against cyphertext[{bnum}]")
         plt.savefig(f"./leakage_cypher_byte_{bnum}_{num_traces}{args.note}.png", dpi=600)
+        cpa_profile.stop("plot")
 
         bar.next()
 
     bar.finish()
 
+cpa_profile.start("plot")
 plt.figure(figsize=(20, 5))  # Width is 12, height is 5
 for i in range(BNUM):
     plt.plot(cpaoutput[i], zorder=1)
 plt.axvline(x=5000, color="blue", lw=3, zorder=2, label="AES-decrypt, Start")
 plt.savefig(f"./leakage_cypher_all_bytes_{num_traces}{args.note}.png", dpi=600)
+cpa_profile.stop("plot")
 
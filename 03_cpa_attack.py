@@ -7,6 +7,7 @@ import sys
 
 import argparse
 import cpa_utils
+import cpa_profile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--traces", help="Path to traces", required=True)
@@ -16,7 +17,14 @@ parser.add_argument("--count", help="Number of sample to use", type=int, default
 parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
 parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
 parser.add_argument("--note", help="Add a note to plots", default="")
+parser.add_argument("--group", help="Average traces sharing the same cyphertext", action="store_true")
+parser.add_argument("--screen", help="Drop badly aligned and outlier traces before the CPA", action="store_true")
+parser.add_argument("--maxshift", help="Maximum alignment shift accepted by the screening", type=int, default=None)
+parser.add_argument("--downweight", help="Weight of the traces flagged by the screening (0 = drop them)", type=float, default=0.0)
+parser.add_argument("--windows", help="Align each segment of the traces on its own window, e.g. 10:110,12000:12100", default=None)
+cpa_profile.add_argument(parser)
 args = parser.parse_args()
+cpa_profile.setup(args)
 
 start_point_for_align = args.sa
 end_point_for_align   = args.ea
@@ -28,17 +36,57 @@ console = Console(highlight=False)
 
 KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
 
+cpa_profile.start("load")
 plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
 
 num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("align")
 print("Align traces...")
 
-reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
-aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+# The single window alignment also gives the metrics used by the screening,
+# it is only needed with --windows if the traces are screened
+if args.windows is None or args.screen:
+    reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
+    aligned_traces, peaks, ratios, shifts = cpa_utils.align_traces(reference_trace, traces, start_point_for_align, end_point_for_align)
+
+if args.windows is not None:
+    # Piecewise alignment
+    windows = [tuple(int(v) for v in w.split(":")) for w in args.windows.split(",")]
+    references = [cpa_utils.average_trace(traces[:200], start, end) for start, end in windows]
+    aligned_traces, window_shifts = cpa_utils.align_traces_piecewise(references, traces, windows)
+
+    # The screening checks the largest shift applied to a segment
+    shifts = np.abs(window_shifts).max(axis=1)
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
 
 del traces
 
+weights = None
+if args.screen:
+    cpa_profile.start("screen")
+    print("Screen traces...")
+    weights, reasons = cpa_utils.screen_traces(aligned_traces, peaks, ratios, shifts, max_shift=args.maxshift,
+                                               downweight=args.downweight)
+    flagged = np.count_nonzero(weights < 1)
+    print(f"{'Dropped' if args.downweight == 0 else 'Down-weighted'} {flagged}/{num_traces} traces: "
+          + ", ".join(f"{reason}={count}" for reason, count in reasons.items()))
+
+    # Dropped traces are removed, so that they don't cost anything in the CPA
+    keep = weights > 0
+    aligned_traces = aligned_traces[keep]
+    plaintexts = [p for p, k in zip(plaintexts, keep) if k]
+    weights = weights[keep]
+    num_traces = len(aligned_traces)
+    cpa_profile.stop("screen", traces=len(keep), samples=num_samples)
+
+# Traces are grouped once aligned, each acquisition has its own jitter
+if args.group:
+    plaintexts, aligned_traces, weights = cpa_utils.group_by_cyphertext(plaintexts, aligned_traces, weights)
+    print(f"{num_traces} traces grouped into {len(weights)} unique cyphertexts")
+    num_traces = len(aligned_traces)
+
 # Generate the HW values of the T-table
 t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
 
@@ -60,11 +108,13 @@ for bnum in range(0, BNUM):
     cpaoutput = [0]*256
     maxcpa = [0]*256
 
+    cpa_profile.start("cpa")
     with Bar(f"Attacking key byte {bnum}", max=256) as bar:
         # For each guess of a key byte, we compute the coefficients
         for kguess in range(0, 256):
-            cpaoutput[kguess], maxcpa[kguess] = cpa_utils.compute_coeff(bnum, kguess, plaintexts, leakage_model, aligned_traces)
+            cpaoutput[kguess], maxcpa[kguess] = cpa_utils.compute_coeff(bnum, kguess, plaintexts, leakage_model, aligned_traces, weights)
             bar.next()
+        cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
         print("\n\n")
 
         # Sort the guesses by their coefficient (only the first 32)
@@ -88,6 +138,7 @@ for bnum in range(0, BNUM):
         bestguess[bnum] = np.argmax(maxcpa)
         bar.finish()
 
+        cpa_profile.start("plot")
         plt.figure(figsize=(20, 5))
         for i in range(6):
             plt.plot(cpaoutput[best_guesses[i]], label=f"{best_guesses[i]:02X}")
@@ -95,6 +146,7 @@ for bnum in range(0, BNUM):
         plt.title(f"{args.traces} - {num_traces} traces, Key index {bnum}")
         plt.figtext(0.5, 0, " ".join(sys.argv), ha="center")
         plt.savefig(f"key_guess_{bnum}.png", dpi=600, bbox_inches = "tight")
+        cpa_profile.stop("plot")
 
 # Print complete guessed key
 print("Guessed key: ", end="")
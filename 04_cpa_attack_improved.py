@@ -9,6 +9,7 @@ from scipy.signal import find_peaks
 
 import argparse
 import cpa_utils
+import cpa_profile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--traces", help="Path to traces", required=True)
@@ -18,7 +19,9 @@ parser.add_argument("--count", help="Number of sample to use", type=int, default
 parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
 parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
 parser.add_argument("--note", help="Add a note to plots", default="")
+cpa_profile.add_argument(parser)
 args = parser.parse_args()
+cpa_profile.setup(args)
 
 start_point_for_align = args.sa
 end_point_for_align   = args.ea
@@ -30,14 +33,18 @@ console = Console(highlight=False)
 
 KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
 
+cpa_profile.start("load")
 plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
 
 num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("align")
 print("Align traces...")
 
 reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
 aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
 
 del traces
 
@@ -73,11 +80,13 @@ for bnum in range(0, BNUM):
     cpaoutput = [0]*256
     maxcpa = [0]*256
 
+    cpa_profile.start("cpa")
     with Bar(f"Attacking key byte {bnum}", max=256) as bar:
         # For each guess of a key byte, we compute the coefficients
         for kguess in range(0, 256):
             cpaoutput[kguess], maxcpa[kguess] = cpa_utils.compute_coeff(bnum, kguess, plaintexts, leakage_model, aligned_traces)
             bar.next()
+        cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
         print("\n\n")
 
         # Sort the guesses by their coefficient (only the first 32)
@@ -101,6 +110,7 @@ for bnum in range(0, BNUM):
         bestguess[bnum] = np.argmax(maxcpa)
         bar.finish()
 
+        cpa_profile.start("plot")
         list_of_candidates = []
         for i in range(6):
             list_of_candidates.append(cpaoutput[best_guesses[i]])
@@ -155,6 +165,7 @@ for bnum in range(0, BNUM):
         if len(peaks) > 0:
             plt.xlim([peaks[0]-200, peaks[0]+200])
             plt.savefig(f"key_guess_zoomed_{bnum}.png", dpi=600, bbox_inches = "tight")
+        cpa_profile.stop("plot")
 
 # Print complete guessed key
 print("Guessed key         : ", end="")
@@ -7,6 +7,7 @@ import sys
 
 import argparse
 import cpa_utils
+import cpa_profile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--traces", help="Path to traces", required=True)
@@ -16,7 +17,10 @@ parser.add_argument("--count", help="Number of sample to use", type=int, default
 parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
 parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
 parser.add_argument("--note", help="Add a note to plots", default="")
+parser.add_argument("--seed", help="Use the traces in a random order drawn with this seed", type=int, default=None)
+cpa_profile.add_argument(parser)
 args = parser.parse_args()
+cpa_profile.setup(args)
 
 start_point_for_align = args.sa
 end_point_for_align   = args.ea
@@ -28,14 +32,21 @@ console = Console(highlight=False)
 
 KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
 
-plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
+cpa_profile.start("load")
+if cpa_utils.is_trace_store(args.traces):
+    plaintexts, traces = cpa_utils.load_trace_store(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
+else:
+    plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
 
 num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("align")
 print("Align traces...")
 
 reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
 aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
 
 del traces
 
@@ -61,11 +72,13 @@ for bnum in range(10, 11):
     maxcpa = [0]*256
     cpa_evol = [0]*256
 
+    cpa_profile.start("cpa")
     with Bar(f"Attacking key byte {bnum}", max=256) as bar:
         # For each guess of a key byte, we compute the coefficients
         for kguess in range(0, 256):
             cpaoutput[kguess], maxcpa[kguess], cpa_evol[kguess] = cpa_utils.compute_coeff_with_convergence(bnum, kguess, plaintexts, leakage_model, aligned_traces)
             bar.next()
+        cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
         print("\n\n")
 
         # Sort the guesses by their coefficient (only the first 32)
@@ -89,6 +102,7 @@ for bnum in range(10, 11):
         bestguess[bnum] = np.argmax(maxcpa)
         bar.finish()
 
+        cpa_profile.start("plot")
         # Plot evolution for each key guess, highlight the best 6
         plt.clf()
         plt.figure(figsize=(20, 5))
@@ -109,6 +123,7 @@ for bnum in range(10, 11):
         plt.title(f"{args.traces} - {num_traces} traces, Key index {bnum}")
         plt.figtext(0.5, 0, " ".join(sys.argv), ha="center")
         plt.savefig(f"key_guess_{bnum}.png", dpi=600, bbox_inches = "tight")
+        cpa_profile.stop("plot")
 
 # Print complete guessed key
 print("Guessed key: ", end="")
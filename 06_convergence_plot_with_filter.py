@@ -1,6 +1,5 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from progress.bar import Bar
 from rich.table import Table
 from rich.console import Console
 import sys
@@ -9,6 +8,7 @@ from scipy.signal import savgol_filter
 
 import argparse
 import cpa_utils
+import cpa_profile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--traces", help="Path to traces", required=True)
@@ -18,8 +18,14 @@ parser.add_argument("--count", help="Number of sample to use", type=int, default
 parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
 parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
 parser.add_argument("--note", help="Add a note to plots", default="")
+parser.add_argument("--seed", help="Use the traces in a random order drawn with this seed", type=int, default=None)
 parser.add_argument("--bnum", help="Key byte to target", type=int, default=10)
+parser.add_argument("--step", help="Number of traces between two points of the convergence plot", type=int, default=10)
+parser.add_argument("--workers", help="Number of threads sharing the samples (with more than 1, limit the BLAS threads, e.g. OPENBLAS_NUM_THREADS=1)", type=int, default=1)
+parser.add_argument("--tile", help="Number of samples processed by a thread at once", type=int, default=4096)
+cpa_profile.add_argument(parser)
 args = parser.parse_args()
+cpa_profile.setup(args)
 
 start_point_for_align = args.sa
 end_point_for_align   = args.ea
@@ -31,15 +37,23 @@ console = Console(highlight=False)
 
 KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
 
-plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
+cpa_profile.start("load")
+if cpa_utils.is_trace_store(args.traces):
+    plaintexts, traces = cpa_utils.load_trace_store(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
+else:
+    plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
 
 num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("align")
 print("Align traces...")
 
 reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
 aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
 
+cpa_profile.start("filter")
 print("Filter traces...")
 
 filtered_traces = np.empty_like(traces)
@@ -53,27 +67,24 @@ window_length = 11 # Choose a suitable window length (must be odd)
 polyorder = 4  # Choose the order of the polynomial fit
 for i in range(num_traces):
     filtered_traces_11[i] = savgol_filter(aligned_traces[i], window_length, polyorder)
+cpa_profile.stop("filter", traces=2*num_traces, samples=num_samples)
 
 del traces
 
-# Generate the HW values of the T-table
-t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
-
 #-----------------------------------------------------------------------
-# This is our model. We return the hamming weight of the result of:
+# This is our model. We use the hamming weight of the result of:
 # - cypher xor keyguess (which is AddRoundKey)
 # - output of the table with the input equal to the above result
 #-----------------------------------------------------------------------
-def leakage_model(cyphertext_byte, keyguess):
-    return t_table_hw_dec[cyphertext_byte ^ keyguess]
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
 
 # Key bytes we want to attack
 bnum = args.bnum
 
 cpa_tests = {
-    "Non filtered"             : (aligned_traces,     [0]*256, [0]*256, [0]*256, "blue"),
-    "Filtered, WL=17, Order=4" : (filtered_traces,    [0]*256, [0]*256, [0]*256, "green"),
-    "Filtered, WL=11, Order=4" : (filtered_traces_11, [0]*256, [0]*256, [0]*256, "red"),
+    "Non filtered"             : (aligned_traces,     [0]*256, [0]*256, "blue"),
+    "Filtered, WL=17, Order=4" : (filtered_traces,    [0]*256, [0]*256, "green"),
+    "Filtered, WL=11, Order=4" : (filtered_traces_11, [0]*256, [0]*256, "red"),
 }
 
 plt.figure(figsize=(20, 5))
@@ -82,11 +93,15 @@ key_guess_list = [0x84, 0xcb, 0xd6, 0x0e]
 
 # For each guess of a key byte, we compute the coefficients
 for traces_type in cpa_tests:
-    traces, cpaoutput, maxcpa, cpa_evol, color = cpa_tests[traces_type]
-    with Bar(f"Attacking key byte {bnum}", max=len(key_guess_list)) as bar:
-        for kguess in key_guess_list:
-            cpaoutput[kguess], maxcpa[kguess], cpa_evol[kguess] = cpa_utils.compute_coeff_with_convergence(bnum, kguess, plaintexts, leakage_model, traces)
-            bar.next()
+    traces, maxcpa, cpa_evol, color = cpa_tests[traces_type]
+    print(f"Attacking key byte {bnum}, {traces_type}...")
+    cpa_profile.start("cpa")
+    checkpoints, evol = cpa_utils.compute_coeff_all_with_convergence(bnum, plaintexts, t_table_hw_dec, traces, step=args.step,
+                                                                     guesses=key_guess_list, workers=args.workers, tile_size=args.tile)
+    for i, kguess in enumerate(key_guess_list):
+        maxcpa[kguess] = evol[-1, i]
+        cpa_evol[kguess] = evol[:, i]
+    cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
 
     # Sort the guesses by their coefficient (only the first 32)
     best_guesses = np.argsort(maxcpa)[-32:][::-1]
@@ -99,11 +114,11 @@ for traces_type in cpa_tests:
     table.add_column("Difference", justify="center", no_wrap=True)
     for i in range(len(key_guess_list)):
         style = None
-        coeff = max(abs(cpaoutput[best_guesses[i]]))
+        coeff = maxcpa[best_guesses[i]]
         if i == 0:
             diff = "-"
         else:
-            diff = (coeff - max(abs(cpaoutput[best_guesses[i-1]])))*100
+            diff = (coeff - maxcpa[best_guesses[i-1]])*100
         if best_guesses[i] == int(KNOWN_ROUND_10_KEY[bnum], 16):
             style = "bold green"
         table.add_row(f"{best_guesses[i]:02X}", str(coeff), str(diff), style=style)
@@ -115,11 +130,14 @@ for traces_type in cpa_tests:
 
     print("\n\n")
 
+    shown = checkpoints >= 5000
     for kguess in key_guess_list:
         if kguess == int(KNOWN_ROUND_10_KEY[bnum], 16):
-            plt.plot(cpa_evol[kguess][5000:], color=color, zorder=2, label=traces_type)
+            plt.plot(checkpoints[shown], cpa_evol[kguess][shown], color=color, zorder=2, label=traces_type)
         else:
-            plt.plot(cpa_evol[kguess][5000:], alpha=0.5, color=color, zorder=1)
+            plt.plot(checkpoints[shown], cpa_evol[kguess][shown], alpha=0.5, color=color, zorder=1)
 
+cpa_profile.start("plot")
 plt.legend()
 plt.savefig(f"cpa_convergence_filtered_for_key_{bnum}.png", dpi=600)
+cpa_profile.stop("plot")
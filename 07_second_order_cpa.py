@@ -0,0 +1,102 @@
+import numpy as np
+from rich.table import Table
+from rich.console import Console
+
+import argparse
+import cpa_utils
+import cpa_profile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path to traces", required=True)
+parser.add_argument("--num", help="Number of traces to use", type=int, default=20000)
+parser.add_argument("--start", help="Sample where we start the analysis", type=int, default=0)
+parser.add_argument("--count", help="Number of sample to use", type=int, default=25000)
+parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
+parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
+parser.add_argument("--windows", help="Windows where the sample pairs are taken, e.g. 5200:5400,8000:8200", default=None)
+parser.add_argument("--pois", help="Points of interest where the sample pairs are taken, e.g. 5210,5230,8100", default=None)
+parser.add_argument("--mode", help="Combination of the two samples", choices=["product", "absdiff"], default="product")
+parser.add_argument("--memory", help="Memory budget for the combined samples (MB)", type=int, default=1024)
+parser.add_argument("--workers", help="Number of worker threads (default: number of cores)", type=int, default=None)
+parser.add_argument("--bnum", help="Key byte to target (default: all)", type=int, default=None)
+cpa_profile.add_argument(parser)
+args = parser.parse_args()
+cpa_profile.setup(args)
+
+if args.windows is None and args.pois is None:
+    parser.error("one of --windows or --pois is required")
+
+windows = None
+pois = None
+if args.pois is not None:
+    pois = [int(p) for p in args.pois.split(",")]
+else:
+    windows = [tuple(int(v) for v in w.split(":")) for w in args.windows.split(",")]
+
+start_point_for_align = args.sa
+end_point_for_align   = args.ea
+num_traces            = args.num
+sample_start          = args.start
+sample_count          = args.count
+
+console = Console(highlight=False)
+
+KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
+
+cpa_profile.start("load")
+plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
+
+num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
+
+cpa_profile.start("align")
+print("Align traces...")
+
+reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
+aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
+
+del traces
+
+# Generate the HW values of the T-table
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
+
+bestguess = [0]*16
+
+key_bytes = range(16) if args.bnum is None else [args.bnum]
+
+for bnum in key_bytes:
+    print(f"Attacking key byte {bnum}...")
+
+    cpa_profile.start("cpa")
+    maxcpa, best_pairs = cpa_utils.compute_coeff_second_order(bnum, plaintexts, t_table_hw_dec, aligned_traces,
+                                                              windows=windows, pois=pois, mode=args.mode,
+                                                              memory_mb=args.memory, workers=args.workers)
+    cpa_profile.stop("cpa", traces=num_traces, samples=num_samples)
+
+    # Sort the guesses by their coefficient
+    best_guesses = np.argsort(maxcpa)[::-1]
+
+    # Print the six best key guesses, their coefficient and the sample pair. Highlight the known key byte if present
+    table = Table(title=f"Best guesses for key byte {bnum} (second order, {args.mode})")
+    table.add_column("Guess", justify="center", no_wrap=True)
+    table.add_column("Coefficient", justify="center", no_wrap=True)
+    table.add_column("Samples", justify="center", no_wrap=True)
+    for i in range(6):
+        style = None
+        if best_guesses[i] == int(KNOWN_ROUND_10_KEY[bnum], 16):
+            style = "bold green"
+        table.add_row(f"{best_guesses[i]:02X}", str(maxcpa[best_guesses[i]]),
+                      f"{best_pairs[best_guesses[i]][0]}, {best_pairs[best_guesses[i]][1]}", style=style)
+    console.print(table)
+
+    bestguess[bnum] = best_guesses[0]
+
+# Print complete guessed key
+print("Guessed key: ", end="")
+for i in key_bytes:
+    style = None
+    if int(KNOWN_ROUND_10_KEY[i], 16) == bestguess[i]:
+        style = "bold green"
+    console.print(f"{bestguess[i]:02X} ", end="", style=style)
+print("\n")
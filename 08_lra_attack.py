@@ -0,0 +1,104 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from progress.bar import Bar
+from rich.table import Table
+from rich.console import Console
+import sys
+
+import argparse
+import cpa_utils
+import cpa_profile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path to traces", required=True)
+parser.add_argument("--num", help="Number of traces to use", type=int, default=20000)
+parser.add_argument("--start", help="Sample where we start the analysis", type=int, default=0)
+parser.add_argument("--count", help="Number of sample to use", type=int, default=25000)
+parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
+parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
+parser.add_argument("--basis", help="Regression basis", choices=["t_table", "hw_bytes"], default="t_table")
+parser.add_argument("--note", help="Add a note to plots", default="")
+cpa_profile.add_argument(parser)
+args = parser.parse_args()
+cpa_profile.setup(args)
+
+start_point_for_align = args.sa
+end_point_for_align   = args.ea
+num_traces            = args.num
+sample_start          = args.start
+sample_count          = args.count
+
+console = Console(highlight=False)
+
+KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
+
+cpa_profile.start("load")
+plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count)
+
+num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
+
+cpa_profile.start("align")
+print("Align traces...")
+
+reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
+aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
+
+del traces
+
+bestguess = [0]*16
+
+# Number of key bytes we want to attack
+BNUM = 16
+
+with Bar("Linear regression attack", max=BNUM) as bar:
+    for bnum in range(0, BNUM):
+
+        cpa_profile.start("lra")
+        r2, maxr2 = cpa_utils.compute_lra(bnum, plaintexts, aligned_traces, basis=args.basis)
+        cpa_profile.stop("lra", traces=num_traces, samples=num_samples)
+        bar.next()
+        print("\n\n")
+
+        # Sort the guesses by their goodness of fit (only the first 32)
+        best_guesses = np.argsort(maxr2)[-32:][::-1]
+        result = " ".join(f"{i:02X}" for i in best_guesses)
+
+        # Print the six best key guesses and their R^2. Highlight the known key byte if present
+        table = Table(title=f"Best guesses for key byte {bnum} ({args.basis} basis)")
+        table.add_column("Guess", justify="center", no_wrap=True)
+        table.add_column("R^2", justify="center", no_wrap=True)
+        for i in range(6):
+            style = None
+            if best_guesses[i] == int(KNOWN_ROUND_10_KEY[bnum], 16):
+                style = "bold green"
+            table.add_row(f"{best_guesses[i]:02X}", str(maxr2[best_guesses[i]]), style=style)
+        console.print(table)
+
+        # Print the 32 best key guesses
+        highlighted_text = result.replace(KNOWN_ROUND_10_KEY[bnum], "[green]["+KNOWN_ROUND_10_KEY[bnum]+"][/green]")
+        console.print("Ranking: " + highlighted_text)
+        bestguess[bnum] = np.argmax(maxr2)
+
+        cpa_profile.start("plot")
+        plt.figure(figsize=(20, 5))
+        for i in range(6):
+            plt.plot(r2[best_guesses[i]], label=f"{best_guesses[i]:02X}")
+        plt.legend()
+        plt.title(f"{args.traces} - {num_traces} traces, Key index {bnum}, LRA ({args.basis})")
+        plt.figtext(0.5, 0, " ".join(sys.argv), ha="center")
+        plt.savefig(f"lra_key_guess_{bnum}{args.note}.png", dpi=600, bbox_inches = "tight")
+        plt.close()
+        cpa_profile.stop("plot")
+
+    bar.finish()
+
+# Print complete guessed key
+print("Guessed key: ", end="")
+for i, b in enumerate(bestguess):
+    style = None
+    if int(KNOWN_ROUND_10_KEY[i], 16) == b:
+        style = "bold green"
+    console.print(f"{b:02X} ", end="", style=style)
+print("\n")
@@ -0,0 +1,101 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from rich.table import Table
+from rich.console import Console
+import sys
+
+import argparse
+import cpa_utils
+import cpa_profile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path to traces", required=True)
+parser.add_argument("--num", help="Number of traces to use", type=int, default=20000)
+parser.add_argument("--start", help="Sample where we start the analysis", type=int, default=0)
+parser.add_argument("--count", help="Number of sample to use", type=int, default=25000)
+parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
+parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
+parser.add_argument("--note", help="Add a note to plots", default="")
+parser.add_argument("--seed", help="Use the traces in a random order drawn with this seed", type=int, default=None)
+parser.add_argument("--step", help="Number of traces between two checkpoints", type=int, default=100)
+parser.add_argument("--bnum", help="Key byte to track (default: all)", type=int, default=None)
+parser.add_argument("--output", help="CSV file where checkpoints are written", default=None)
+parser.add_argument("--workers", help="Number of threads sharing the samples (with more than 1, limit the BLAS threads, e.g. OPENBLAS_NUM_THREADS=1)", type=int, default=1)
+parser.add_argument("--tile", help="Number of samples processed by a thread at once", type=int, default=4096)
+cpa_profile.add_argument(parser)
+args = parser.parse_args()
+cpa_profile.setup(args)
+
+start_point_for_align = args.sa
+end_point_for_align   = args.ea
+num_traces            = args.num
+sample_start          = args.start
+sample_count          = args.count
+
+console = Console(highlight=False)
+
+KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
+
+cpa_profile.start("load")
+if cpa_utils.is_trace_store(args.traces):
+    plaintexts, traces = cpa_utils.load_trace_store(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
+else:
+    plaintexts, traces = cpa_utils.load_npz_traces(num_traces, args.traces, sample_start, sample_count, seed=args.seed)
+
+num_traces, num_samples = traces.shape
+cpa_profile.stop("load", traces=num_traces, samples=num_samples)
+
+cpa_profile.start("align")
+print("Align traces...")
+
+reference_trace = cpa_utils.average_trace(traces[:200], start_point_for_align, end_point_for_align)
+aligned_traces  = np.array([cpa_utils.align_trace(reference_trace, trace, start_point_for_align, end_point_for_align) for trace in traces])
+cpa_profile.stop("align", traces=num_traces, samples=num_samples)
+
+del traces
+
+# Generate the HW values of the T-table
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
+
+known_key = [int(b, 16) for b in KNOWN_ROUND_10_KEY]
+key_bytes = range(16) if args.bnum is None else [args.bnum]
+output    = args.output or f"convergence_{num_traces}{args.note}.csv"
+
+cpa_profile.start("cpa")
+last = cpa_utils.track_convergence(output, plaintexts, t_table_hw_dec, aligned_traces, known_key, key_bytes, step=args.step,
+                                     workers=args.workers, tile_size=args.tile)
+cpa_profile.stop("cpa", traces=num_traces * len(key_bytes), samples=num_samples)
+
+# Print the state of the last checkpoint for each byte
+table = Table(title=f"Known key rank after {num_traces} traces")
+table.add_column("Byte", justify="center", no_wrap=True)
+table.add_column("Rank", justify="center", no_wrap=True)
+table.add_column("Margin", justify="center", no_wrap=True)
+table.add_column("Coefficient", justify="center", no_wrap=True)
+for bnum in key_bytes:
+    record = last[bnum]
+    style = "bold green" if record["rank"] == 0 else None
+    table.add_row(str(bnum), str(record["rank"]), f"{record['margin']:.4f}", f"{record['known_coeff']:.4f}", style=style)
+console.print(table)
+print(f"Checkpoints written to {output}")
+
+# Plot the evolution of the rank and of the margin, from the records on disk
+cpa_profile.start("plot")
+records = cpa_utils.read_convergence(output)
+
+fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(20, 10), sharex=True)
+for bnum in key_bytes:
+    byte_records = [r for r in records if r["bnum"] == bnum]
+    counts = [r["traces"] for r in byte_records]
+    ax1.plot(counts, [r["rank"] for r in byte_records], label=f"{bnum}")
+    ax2.plot(counts, [r["margin"] for r in byte_records], label=f"{bnum}")
+ax1.set_yscale("symlog")
+ax1.set_ylabel("Rank of the known key byte")
+ax2.axhline(y=0, color="black", lw=1)
+ax2.set_ylabel("Margin to the best wrong guess")
+ax2.set_xlabel("Number of traces")
+ax1.legend(ncol=8)
+ax1.set_title(f"{args.traces}, Convergence of the known key")
+plt.figtext(0.5, 0, " ".join(sys.argv), ha="center")
+plt.savefig(f"cpa_rank_convergence_{num_traces}{args.note}.png", dpi=600, bbox_inches = "tight")
+cpa_profile.stop("plot")
@@ -0,0 +1,94 @@
+import numpy as np
+from rich.table import Table
+from rich.console import Console
+
+import argparse
+import cpa_utils
+import cpa_profile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path to a trace store (see build_trace_store.py)", required=True)
+parser.add_argument("--num", help="Number of traces to use", type=int, default=20000)
+parser.add_argument("--seed", help="Use traces drawn in a random order with this seed", type=int, default=None)
+parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
+parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
+parser.add_argument("--levels", help="Binning factors of the pyramid (1 is always built)", default="1,4,16")
+parser.add_argument("--factor", help="Pyramid level used to locate the leakage", type=int, default=16)
+parser.add_argument("--threshold", help="Robust z-score above which a coarse bin is kept", type=float, default=5.0)
+parser.add_argument("--margin", help="Samples added on each side of a selected bin", type=int, default=16)
+parser.add_argument("--rebuild", help="Rebuild the pyramid", action="store_true")
+parser.add_argument("--workers", help="Number of threads sharing the samples (with more than 1, limit the BLAS threads, e.g. OPENBLAS_NUM_THREADS=1)", type=int, default=1)
+parser.add_argument("--tile", help="Number of samples processed by a thread at once", type=int, default=4096)
+cpa_profile.add_argument(parser)
+args = parser.parse_args()
+cpa_profile.setup(args)
+
+if not cpa_utils.is_trace_store(args.traces):
+    parser.error(f"{args.traces} is not a trace store, create it with build_trace_store.py")
+
+console = Console(highlight=False)
+
+KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
+
+factors = [int(f) for f in args.levels.split(",")]
+if args.factor not in factors:
+    parser.error(f"--factor {args.factor} is not one of the --levels ({args.levels})")
+
+# The pyramid is computed once (aligned traces) and memory-mapped afterwards. It
+# is rebuilt if it was built from another store or with other parameters
+if args.rebuild or not cpa_utils.trace_pyramid_matches(args.traces, factors, args.sa, args.ea):
+    cpa_profile.start("pyramid")
+    cpa_utils.build_trace_pyramid(args.traces, factors, args.sa, args.ea)
+    cpa_profile.stop("pyramid")
+
+levels = cpa_utils.open_trace_pyramid(args.traces)
+
+cyphertexts, _ = cpa_utils.open_trace_store(args.traces)
+indices = cpa_utils.select_traces(args.num, len(cyphertexts), args.seed)
+plaintexts = [c.tobytes() for c in cyphertexts[indices]]
+
+num_traces  = len(indices)
+num_samples = levels[1].shape[1]
+
+# Generate the HW values of the T-table
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
+
+bestguess = [0]*16
+
+# Number of key bytes we want to attack
+BNUM = 16
+
+for bnum in range(0, BNUM):
+    print(f"Attacking key byte {bnum}...")
+
+    cpa_profile.start("cpa")
+    windows, maxcpa = cpa_utils.coarse_to_fine_cpa(bnum, plaintexts, t_table_hw_dec, levels, indices, args.factor,
+                                                   args.threshold, args.margin, workers=args.workers,
+                                                   tile_size=args.tile)
+    cpa_profile.stop("cpa", traces=num_traces, samples=num_samples // args.factor + sum(end - start for start, end in windows))
+
+    # Sort the guesses by their coefficient
+    best_guesses = np.argsort(maxcpa)[::-1]
+
+    # Print the six best key guesses and their coefficient. Highlight the known key byte if present
+    windows_text = ", ".join(f"{start}-{end}" for start, end in windows)
+    table = Table(title=f"Best guesses for key byte {bnum}, windows {windows_text}")
+    table.add_column("Guess", justify="center", no_wrap=True)
+    table.add_column("Coefficient", justify="center", no_wrap=True)
+    for i in range(6):
+        style = None
+        if best_guesses[i] == int(KNOWN_ROUND_10_KEY[bnum], 16):
+            style = "bold green"
+        table.add_row(f"{best_guesses[i]:02X}", str(maxcpa[best_guesses[i]]), style=style)
+    console.print(table)
+
+    bestguess[bnum] = best_guesses[0]
+
+# Print complete guessed key
+print("Guessed key: ", end="")
+for i, b in enumerate(bestguess):
+    style = None
+    if int(KNOWN_ROUND_10_KEY[i], 16) == b:
+        style = "bold green"
+    console.print(f"{b:02X} ", end="", style=style)
+print("\n")
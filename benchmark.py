@@ -0,0 +1,112 @@
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.signal import savgol_filter
+from rich.table import Table
+from rich.console import Console
+
+import argparse
+import cpa_utils
+import cpa_synth
+
+#--------------------------------------------------------------
+# Time each stage of the CPA pipeline on synthetic traces, for
+# several (traces x samples) sizes, and check that the known key
+# is recovered. The exit status is 1 if the key is not fully
+# recovered for one of the sizes.
+#--------------------------------------------------------------
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes", help="Comma separated list of TRACESxSAMPLES", default="1000x2000,5000x5000,20000x5000")
+parser.add_argument("--noise", help="Standard deviation of the noise", type=float, default=1.0)
+parser.add_argument("--leak", help="Amplitude of the leakage per bit of hamming weight", type=float, default=0.1)
+parser.add_argument("--jitter", help="Maximum random shift of a trace", type=int, default=5)
+parser.add_argument("--sa", help="Index of the sample used for the start of the alignment window", type=int, default=10)
+parser.add_argument("--ea", help="Index of the sample used for the end of the alignment window", type=int, default=110)
+parser.add_argument("--bnum", help="Key byte used for the convergence", type=int, default=10)
+parser.add_argument("--seed", help="Seed of the random generator", type=int, default=0)
+parser.add_argument("--output", help="JSON file where results are written", default="benchmark.json")
+args = parser.parse_args()
+
+console = Console(highlight=False)
+
+key = cpa_synth.default_key()
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
+
+STAGES = ["load", "align", "filter", "cpa", "convergence"]
+
+def timed(results, name, function, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = function(*args, **kwargs)
+    results[name] = time.perf_counter() - t0
+    return ret
+
+def attack_all_bytes(plaintexts, traces):
+    return [int(np.argmax(cpa_utils.compute_coeff_all(bnum, plaintexts, t_table_hw_dec, traces)[1])) for bnum in range(16)]
+
+results = []
+
+for size in args.sizes.split(","):
+    num_traces, num_samples = (int(v) for v in size.lower().split("x"))
+    console.print(f"[bold]{num_traces} traces x {num_samples} samples[/bold]")
+
+    folder = tempfile.mkdtemp(prefix="cpa_bench_")
+    try:
+        cyphertexts, traces = cpa_synth.generate_traces(num_traces, key, num_samples, noise=args.noise,
+                                                        leak=args.leak, jitter=args.jitter, seed=args.seed)
+        cpa_synth.write_npz_traces(folder, cyphertexts, traces)
+        del traces
+
+        timings = {}
+        plaintexts, traces = timed(timings, "load", cpa_utils.load_npz_traces, num_traces, folder, 0, num_samples)
+
+        reference_trace = cpa_utils.average_trace(traces[:200], args.sa, args.ea)
+        aligned_traces = timed(timings, "align", cpa_utils.align_traces, reference_trace, traces, args.sa, args.ea)[0]
+
+        timed(timings, "filter", savgol_filter, aligned_traces, 17, 4, axis=1)
+
+        guessed = timed(timings, "cpa", attack_all_bytes, plaintexts, aligned_traces)
+
+        checkpoints, cpa_evol = timed(timings, "convergence", cpa_utils.compute_coeff_all_with_convergence,
+                                      args.bnum, plaintexts, t_table_hw_dec, aligned_traces, step=max(num_traces // 20, 1))
+    finally:
+        shutil.rmtree(folder)
+
+    # First checkpoint from which the known key byte stays the best guess
+    ranked_first = np.argmax(cpa_evol, axis=1) == key[args.bnum]
+    converged = None
+    if ranked_first[-1]:
+        wrong = np.nonzero(~ranked_first)[0]
+        converged = int(checkpoints[wrong[-1] + 1]) if len(wrong) else int(checkpoints[0])
+
+    results.append({
+        "traces"            : num_traces,
+        "samples"           : num_samples,
+        "seconds"           : timings,
+        "samples_per_second": {stage: num_traces * num_samples / timings[stage] for stage in STAGES},
+        "bytes_recovered"   : sum(g == k for g, k in zip(guessed, key)),
+        "guessed_key"       : bytes(guessed).hex(),
+        "converged_at"      : converged,
+    })
+
+table = Table(title="CPA pipeline benchmark (seconds)")
+table.add_column("Traces x samples", justify="center", no_wrap=True)
+for stage in STAGES:
+    table.add_column(stage.capitalize(), justify="center", no_wrap=True)
+table.add_column("Key bytes", justify="center", no_wrap=True)
+table.add_column(f"Byte {args.bnum} converged at", justify="center", no_wrap=True)
+for r in results:
+    style = "bold green" if r["bytes_recovered"] == 16 else "bold red"
+    table.add_row(f"{r['traces']}x{r['samples']}", *(f"{r['seconds'][stage]:.2f}" for stage in STAGES),
+                  f"{r['bytes_recovered']}/16", str(r["converged_at"]), style=style)
+console.print(table)
+
+with open(args.output, "w") as f:
+    json.dump({"key": key.hex(), "noise": args.noise, "leak": args.leak, "jitter": args.jitter, "results": results}, f, indent=2)
+
+if any(r["bytes_recovered"] < 16 for r in results):
+    sys.exit(1)
@@ -0,0 +1,11 @@
+import argparse
+import cpa_utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path to traces", required=True)
+parser.add_argument("--store", help="Path of the trace store to create", required=True)
+parser.add_argument("--start", help="First sample to store", type=int, default=0)
+parser.add_argument("--count", help="Number of sample to store", type=int, default=25000)
+args = parser.parse_args()
+
+cpa_utils.build_trace_store(args.traces, args.store, args.start, args.count)
@@ -0,0 +1,182 @@
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from scipy.signal import savgol_filter
+from rich.table import Table
+from rich.console import Console
+
+import argparse
+import cpa_utils
+
+#--------------------------------------------------------------
+# Run the CPA over a grid of trace folders and parameters, and write
+# one row per configuration to a CSV results table.
+#
+# The campaign is described by a JSON file:
+#
+# {
+#     "folders": ["traces/board1", "traces/board2"],
+#     "grid": {
+#         "num"    : [2000, 5000, 10000],
+#         "start"  : [0],
+#         "count"  : [25000],
+#         "sa"     : [10],
+#         "ea"     : [110],
+#         "filter" : [null, "17:4", "11:4"],
+#         "seed"   : [null]
+#     },
+#     "bytes": [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15],
+#     "key": "EEBDE8B117F05A5C660B84367704D0B3"
+# }
+#
+# filter is "window_length:polyorder" of a Savitzky-Golay filter, or
+# null. Missing grid entries take the default values of the scripts.
+#
+# Configurations sharing a folder, start, count and seed share the
+# loaded traces (loaded once, for the largest num), and those also
+# sharing the alignment window and the filter share the preprocessed
+# traces. The attacks of a preprocessed set are run by a pool of
+# threads, and are done before the next set is preprocessed.
+#
+# The cost of a configuration (total_seconds) is its attack time plus
+# its share of the load and preprocess times, which are proportional
+# to the number of traces.
+#--------------------------------------------------------------
+
+KNOWN_ROUND_10_KEY = "EEBDE8B117F05A5C660B84367704D0B3"
+
+DEFAULTS = {
+    "num"    : [20000],
+    "start"  : [0],
+    "count"  : [25000],
+    "sa"     : [10],
+    "ea"     : [110],
+    "filter" : [None],
+    "seed"   : [None],
+}
+
+FIELDS = ["config", "folder", "num", "start", "count", "sa", "ea", "filter", "seed",
+          "recovered", "success", "max_rank", "mean_rank", "guessed_key",
+          "load_seconds", "preprocess_seconds", "attack_seconds", "total_seconds"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--campaign", help="JSON description of the campaign", required=True)
+parser.add_argument("--output", help="CSV results table", default="campaign_results.csv")
+parser.add_argument("--workers", help="Number of attacks run in parallel", type=int, default=os.cpu_count())
+args = parser.parse_args()
+
+console = Console(highlight=False)
+
+with open(args.campaign) as f:
+    campaign = json.load(f)
+
+grid = dict(DEFAULTS, **campaign.get("grid", {}))
+key_bytes = campaign.get("bytes", list(range(16)))
+known_key = bytes.fromhex(campaign.get("key", KNOWN_ROUND_10_KEY))
+
+names = list(DEFAULTS)
+configs = [dict(zip(names, values), folder=folder)
+           for folder in campaign["folders"]
+           for values in itertools.product(*(grid[name] for name in names))]
+for i, config in enumerate(configs):
+    config["config"] = i
+
+t_table_hw_dec = cpa_utils.hw_t_table_decrypt()
+
+def load_key(config):
+    return (config["folder"], config["start"], config["count"], config["seed"])
+
+def preprocess_key(config):
+    return (config["sa"], config["ea"], config["filter"])
+
+def load(folder, start, count, seed, num):
+    if cpa_utils.is_trace_store(folder):
+        return cpa_utils.load_trace_store(num, folder, start, count, seed=seed)
+    return cpa_utils.load_npz_traces(num, folder, start, count, seed=seed)
+
+def preprocess(traces, sa, ea, savgol):
+    reference_trace = cpa_utils.average_trace(traces[:200], sa, ea)
+    aligned_traces, _ = cpa_utils.align_traces_piecewise([reference_trace], traces, [(sa, ea)])
+
+    if savgol is not None:
+        window_length, polyorder = (int(v) for v in savgol.split(":"))
+        aligned_traces = savgol_filter(aligned_traces, window_length, polyorder, axis=1).astype(np.float32)
+
+    return aligned_traces
+
+def attack(config, plaintexts, traces):
+    t0 = time.perf_counter()
+    num = config["num"]
+
+    guessed = []
+    ranks = []
+    for bnum in key_bytes:
+        _, maxcpa = cpa_utils.compute_coeff_all(bnum, plaintexts[:num], t_table_hw_dec, traces[:num])
+        guessed.append(int(np.argmax(maxcpa)))
+        ranks.append(int(np.count_nonzero(maxcpa > maxcpa[known_key[bnum]])))
+
+    recovered = sum(rank == 0 for rank in ranks)
+    return dict(config,
+                num            = min(num, len(traces)),
+                recovered      = recovered,
+                success        = recovered == len(key_bytes),
+                max_rank       = max(ranks),
+                mean_rank      = float(np.mean(ranks)),
+                guessed_key    = bytes(guessed).hex(),
+                attack_seconds = time.perf_counter() - t0)
+
+results = []
+
+with open(args.output, "w", newline="") as f, ThreadPoolExecutor(max_workers=args.workers) as executor:
+    writer = csv.DictWriter(f, fieldnames=FIELDS)
+    writer.writeheader()
+
+    # One group per set of loaded traces, the traces are freed when the group is done
+    configs.sort(key=lambda c: (repr(load_key(c)), repr(preprocess_key(c))))
+    for (folder, start, count, seed), load_group in itertools.groupby(configs, key=load_key):
+        load_group = list(load_group)
+        console.print(f"[bold]{folder}[/bold] (start={start}, count={count}, seed={seed}): {len(load_group)} configurations")
+
+        t0 = time.perf_counter()
+        plaintexts, traces = load(folder, start, count, seed, max(c["num"] for c in load_group))
+        load_seconds = time.perf_counter() - t0
+
+        for (sa, ea, savgol), group in itertools.groupby(load_group, key=preprocess_key):
+            print(f"Preprocess traces (sa={sa}, ea={ea}, filter={savgol})...")
+            t0 = time.perf_counter()
+            preprocessed = preprocess(traces, sa, ea, savgol)
+            preprocess_seconds = time.perf_counter() - t0
+
+            futures = [executor.submit(attack, config, plaintexts, preprocessed) for config in group]
+
+            # Rows are written as soon as the attacks are done
+            for future in as_completed(futures):
+                result = future.result()
+                share = result["num"] / len(traces)
+                result["load_seconds"] = load_seconds * share
+                result["preprocess_seconds"] = preprocess_seconds * share
+                result["total_seconds"] = result["load_seconds"] + result["preprocess_seconds"] + result["attack_seconds"]
+                writer.writerow(result)
+                f.flush()
+                results.append(result)
+
+            del futures, preprocessed
+
+        del plaintexts, traces
+
+# The cheapest successful configurations: fewest traces, then fewest samples
+successful = sorted((r for r in results if r["success"]), key=lambda r: (r["num"], r["count"], r["total_seconds"]))
+
+table = Table(title=f"Cheapest successful configurations ({len(successful)}/{len(results)} successful)")
+for column in ["Folder", "Traces", "Start", "Count", "Sa", "Ea", "Filter", "Seed", "Seconds"]:
+    table.add_column(column, justify="center", no_wrap=True)
+for r in successful[:10]:
+    table.add_row(r["folder"], str(r["num"]), str(r["start"]), str(r["count"]), str(r["sa"]), str(r["ea"]),
+                  str(r["filter"]), str(r["seed"]), f"{r['total_seconds']:.2f}")
+console.print(table)
+print(f"Results written to {args.output}")
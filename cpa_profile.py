@@ -0,0 +1,149 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+#--------------------------------------------------------------
+# Stage timing for the CPA scripts.
+#
+# Each pipeline stage is wrapped in a named span:
+#
+#     cpa_profile.start("align")
+#     ...
+#     cpa_profile.stop("align", traces=num_traces, samples=num_samples)
+#
+# or with cpa_profile.span("align", ...). When profiling is not
+# enabled (no --profile on the command line), these calls do nothing.
+#
+# For each span we record the duration, the peak RSS of the process
+# at the end of the span, how much the span raised that peak and, if
+# the number of traces and samples processed is given, the throughput.
+#
+# With --profile-memory, the peak of memory allocated by numpy/python
+# during each span is also recorded (tracemalloc). Tracing the
+# allocations slows the scripts down a lot, so the durations of such
+# a run should not be compared with a --profile run.
+#--------------------------------------------------------------
+
+_enabled = False
+_memory = False
+_output = None
+_t0 = 0.0
+_spans = []
+_open = []
+
+def add_argument(parser):
+    parser.add_argument("--profile", help="Write timing metrics to a JSON file", action="store_true")
+    parser.add_argument("--profile-memory", help="Same as --profile, and also trace the allocations (slower)",
+                        action="store_true")
+
+# Peak resident set size of the process, in MB
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kB on Linux
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+#--------------------------------------------------------------
+# Enable profiling. The metrics are written to 'output' when the
+# script exits (default: profile_<script>_<date>.json). If memory is
+# True, the allocations are traced.
+#--------------------------------------------------------------
+def enable(output=None, memory=False):
+    global _enabled, _memory, _output, _t0
+
+    if output is None:
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        output = f"profile_{script}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+
+    _enabled = True
+    _memory = memory
+    _output = output
+    _t0 = time.perf_counter()
+    if memory:
+        tracemalloc.start()
+    atexit.register(write_json)
+
+# Enable profiling if --profile or --profile-memory was given
+def setup(args):
+    if args.profile or args.profile_memory:
+        enable(memory=args.profile_memory)
+
+def start(name):
+    if not _enabled:
+        return
+
+    # Memory peak reached so far belongs to the enclosing span
+    if _memory:
+        _, peak = tracemalloc.get_traced_memory()
+        if _open:
+            _open[-1]["alloc_peak"] = max(_open[-1]["alloc_peak"], peak)
+        tracemalloc.reset_peak()
+
+    _open.append({"name": name, "t0": time.perf_counter(), "alloc_peak": 0, "rss_peak": peak_rss_mb()})
+
+def stop(name, traces=None, samples=None):
+    if not _enabled:
+        return
+
+    entry = _open.pop()
+    if entry["name"] != name:
+        raise RuntimeError(f"Profiling span '{name}' stopped while '{entry['name']}' is open")
+
+    seconds = time.perf_counter() - entry["t0"]
+    rss_peak = peak_rss_mb()
+
+    # process_rss_peak_mb is the peak of the whole run so far, the span
+    # itself is only responsible for its increase
+    record = {
+        "name"                : name,
+        "depth"               : len(_open),
+        "start"               : entry["t0"] - _t0,
+        "seconds"             : seconds,
+        "process_rss_peak_mb" : rss_peak,
+        "rss_peak_growth_mb"  : rss_peak - entry["rss_peak"],
+    }
+
+    if _memory:
+        _, peak = tracemalloc.get_traced_memory()
+        alloc_peak = max(entry["alloc_peak"], peak)
+        if _open:
+            _open[-1]["alloc_peak"] = max(_open[-1]["alloc_peak"], alloc_peak)
+        record["alloc_peak_mb"] = alloc_peak / (1024 * 1024)
+    if traces is not None:
+        record["traces"] = traces
+        record["traces_per_second"] = traces / seconds if seconds > 0 else None
+        if samples is not None:
+            record["samples"] = samples
+            record["samples_per_second"] = traces * samples / seconds if seconds > 0 else None
+
+    _spans.append(record)
+
+@contextmanager
+def span(name, traces=None, samples=None):
+    start(name)
+    try:
+        yield
+    finally:
+        stop(name, traces, samples)
+
+def metrics():
+    return {
+        "argv"                : sys.argv,
+        "total_seconds"       : time.perf_counter() - _t0,
+        "memory_traced"       : _memory,
+        "process_rss_peak_mb" : peak_rss_mb(),
+        "spans"               : _spans,
+    }
+
+def write_json(path=None):
+    if not _enabled:
+        return
+
+    path = path or _output
+    with open(path, "w") as f:
+        json.dump(metrics(), f, indent=2)
+    print(f"Profile written to {path}")
@@ -0,0 +1,110 @@
+import os
+
+from progress.bar import Bar
+import numpy as np
+
+import cpa_utils
+
+#--------------------------------------------------------------
+# Synthetic traces, to test and benchmark the scripts without the
+# real captures.
+#
+# Each trace has:
+#      - a synchronisation pattern at the start of the trace (in the
+#        default 10-110 alignment window of the scripts). It is a
+#        smoothed pseudo-random burst, the same for all traces, so
+#        that the alignment has a single correlation peak even with
+#        a reference averaged over jittered traces
+#      - a periodic "clock" activity, after the alignment window
+#      - for each cyphertext byte b, a leakage proportional to the
+#        hamming weight of the T-table output for cyphertext[b] ^ key[b],
+#        at sample leak_start + b*leak_spacing
+#      - gaussian noise
+#      - a random shift of the whole trace (jitter)
+#--------------------------------------------------------------
+
+KNOWN_ROUND_10_KEY = ["EE","BD","E8","B1","17","F0","5A","5C","66","0B","84","36","77","04","D0","B3"]
+
+SYNC_START  = 30
+SYNC_END    = 90
+CLOCK_START = 128
+
+# Synchronisation burst: gaussian-smoothed noise (smoothing = 'width'
+# samples) under a Hann window, with a peak of 'amplitude'
+def sync_burst(length, width=3, amplitude=10.0, seed=0x5C):
+    noise = np.random.default_rng(seed).standard_normal(length + 8 * width)
+    kernel = np.exp(-0.5 * (np.arange(-3 * width, 3 * width + 1) / width) ** 2)
+    burst = np.convolve(noise, kernel, mode='same')[4 * width:4 * width + length] * np.hanning(length)
+    return amplitude * burst / np.max(np.abs(burst))
+
+def default_key():
+    return bytes(int(b, 16) for b in KNOWN_ROUND_10_KEY)
+
+#--------------------------------------------------------------
+# Name of the file for a given cyphertext, such that
+# cpa_utils.parse_cyphertext(name) returns it back
+#--------------------------------------------------------------
+def trace_filename(index, cyphertext, middle=0):
+    part1 = int.from_bytes(cyphertext[:8], 'big') ^ 0xc
+    part3 = int.from_bytes(cyphertext[8:], 'big')
+    return f"{index:06d}_{part1:016x}_{middle:016x}_{part3:016x}.npz"
+
+#--------------------------------------------------------------
+# nb_traces   : number of traces to generate
+# key         : 16 bytes round 10 key
+# nb_points   : number of samples per trace
+# noise       : standard deviation of the gaussian noise
+# leak        : amplitude of the leakage, per bit of hamming weight
+# jitter      : maximum random shift of a trace (in samples)
+# leak_start  : sample of the leakage of the first byte
+# leak_spacing: number of samples between the leakage of two bytes
+# repeat      : number of consecutive traces sharing a cyphertext
+#
+# Return the cyphertexts (as a list of bytes) and the traces
+#--------------------------------------------------------------
+def generate_traces(nb_traces, key=None, nb_points=25000, noise=1.0, leak=0.1, jitter=5,
+                    leak_start=None, leak_spacing=None, repeat=1, seed=0):
+    rng = np.random.default_rng(seed)
+    key = np.frombuffer(key or default_key(), dtype=np.uint8)
+
+    if leak_start is None:
+        leak_start = nb_points // 5
+    if leak_spacing is None:
+        leak_spacing = max((nb_points - leak_start - 16) // 32, 1)
+
+    nb_unique = -(-nb_traces // repeat)
+    cyphertexts = np.repeat(rng.integers(0, 256, (nb_unique, 16), dtype=np.uint8), repeat, axis=0)[:nb_traces]
+
+    # Activity common to all traces. The sync burst does not depend on
+    # the seed, all the generated campaigns come from the same "device"
+    t = np.arange(nb_points)
+    base = np.where(t >= CLOCK_START, 0.5 * np.sin(2 * np.pi * t / 16), 0.0)
+    sync = np.arange(SYNC_START, min(SYNC_END, nb_points))
+    base[sync] += sync_burst(SYNC_END - SYNC_START)[:len(sync)]
+
+    traces = base[None, :] + rng.normal(0, noise, (nb_traces, nb_points))
+
+    # Leakage of the T-table lookup of each byte
+    t_table_hw_dec = np.array(cpa_utils.hw_t_table_decrypt(), dtype=np.float64)
+    leakage = t_table_hw_dec[cyphertexts ^ key[None, :]]
+    for b in range(16):
+        position = leak_start + b * leak_spacing
+        if position < nb_points:
+            traces[:, position] += leak * leakage[:, b]
+
+    # Shift each trace by a random amount
+    if jitter > 0:
+        shifts = rng.integers(-jitter, jitter + 1, nb_traces)
+        traces = traces[np.arange(nb_traces)[:, None], (t[None, :] - shifts[:, None]) % nb_points]
+
+    return [c.tobytes() for c in cyphertexts], traces.astype(np.float32)
+
+# Write traces in the ii_aaaa_bbbb_cccc.npz format read by load_npz_traces
+def write_npz_traces(folder_path, cyphertexts, traces):
+    os.makedirs(folder_path, exist_ok=True)
+
+    with Bar('Writing traces', max=len(traces)) as bar:
+        for i, (cyphertext, trace) in enumerate(zip(cyphertexts, traces)):
+            np.savez(os.path.join(folder_path, trace_filename(i, cyphertext)), data=trace)
+            bar.next()
+        bar.finish()
@@ -1,5 +1,8 @@
+import csv
+import json
 import os
-import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from progress.bar import Bar
 import numpy as np
@@ -9,14 +12,91 @@ import numpy as np
 #      - ii             = index
 #      - aaaa_bbbb_cccc = cypher text to key_unwrap
 #
+# Return the 16 bytes cyphertext, or None if the name does not match
+#--------------------------------------------------------------
+def parse_cyphertext(filename):
+    parts = filename.split('_')
+    if len(parts) != 4 or not parts[-1].endswith(".npz"):
+        return None
+
+    part1 = int(parts[1], 16)
+    part1 = (part1 & 0xffffffffffffff00) | ((part1 & 0xff) ^ 0xc)
+    part3 = int(parts[3].split('.')[0], 16)
+    return part1.to_bytes(8, 'big') + part3.to_bytes(8, 'big')
+
+#--------------------------------------------------------------
+# Average all the traces sharing the same cyphertext, wherever they
+# are in the list. Groups are returned in order of first appearance.
+#
+# Each acquisition has its own jitter: call it on aligned traces,
+# averaging before the alignment smears the leakage.
+#
+# weights: optional weight of each trace (e.g. from screen_traces).
+#          The average of a group is then weighted.
+#
+# Return the unique cyphertexts, the averaged traces and the number
+# (or total weight) of traces in each group (to be used as weights
+# by the CPA)
+#--------------------------------------------------------------
+def group_by_cyphertext(cyphertexts, traces, weights=None):
+    if len(cyphertexts) == 0:
+        return [], np.asarray(traces).reshape(0, *np.shape(traces)[1:]), np.zeros(0)
+
+    if weights is None:
+        weights = np.ones(len(traces))
+
+    keys = np.frombuffer(b"".join(cyphertexts), dtype=np.uint8).reshape(-1, 16)
+    unique_keys, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    # Sort traces by group so that each group is a contiguous block
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sums = np.add.reduceat(traces[order] * weights[order, None], boundaries, axis=0, dtype=np.float64)
+    group_weights = np.add.reduceat(weights[order], boundaries)
+
+    # Groups with a null weight are left at zero, the CPA ignores them
+    averaged = (sums / np.where(group_weights > 0, group_weights, 1)[:, None]).astype(traces.dtype)
+
+    # Keep the acquisition order of the first trace of each group
+    first_seen = np.argsort(order[boundaries], kind='stable')
+
+    grouped_cyphertexts = [unique_keys[i].tobytes() for i in first_seen]
+    return grouped_cyphertexts, averaged[first_seen], group_weights[first_seen].astype(np.float64)
+
+# Return the sorted list of trace files of a folder
+def list_npz_traces(folder_path):
+    # Filter and sort filenames for consistent processing
+    return sorted(f for f in os.listdir(folder_path) if parse_cyphertext(f) is not None)
+
+#--------------------------------------------------------------
+# Select nb_traces indices among total traces. Without seed, the
+# first traces are used. With a seed, the traces are drawn in a
+# random (but reproducible) order.
+#--------------------------------------------------------------
+def select_traces(nb_traces, total, seed=None):
+    nb_traces = min(nb_traces, total)
+    if seed is None:
+        return np.arange(nb_traces)
+    return np.random.default_rng(seed).permutation(total)[:nb_traces]
+
+#--------------------------------------------------------------
 # nb_traces  : number for files (one trace per file) to process
 # folder_path: source
 # start      : first point in the file to read
 # nb_points  : number of points to read
 # average    : number of files that have the same cyphertext
 # skip       : skip traces based on the 'average' value
+# seed       : read nb_traces files drawn in a random order
+# indices    : read these files (index in the sorted file list)
+#
+# The averaging works on consecutive files, it can't be used with a
+# random selection of the files (seed or indices).
 #--------------------------------------------------------------
-def load_npz_traces(nb_traces, folder_path, start, nb_points, average=1, skip=False):
+def load_npz_traces(nb_traces, folder_path, start, nb_points, average=1, skip=False, seed=None, indices=None):
+    if average > 1 and not skip and (seed is not None or indices is not None):
+        raise ValueError("average > 1 averages consecutive files, it can't be used with seed or indices")
+
     data_arrays = []
     cyphertexts = []
 
@@ -27,21 +107,18 @@ def load_npz_traces(nb_traces, folder_path, start, nb_points, average=1, skip=Fa
         trace_count = 0  # Count of processed traces
         batch_idx = 0    # Index within the current averaging batch
 
-        # Filter and sort filenames for consistent processing
-        filenames = sorted(f for f in os.listdir(folder_path) if f.endswith(".npz"))
+        filenames = list_npz_traces(folder_path)
+        if seed is not None or indices is not None:
+            if indices is None:
+                indices = select_traces(nb_traces, len(filenames), seed)
+            filenames = [filenames[i] for i in indices]
 
         for filename in filenames:
             if trace_count == nb_traces:
                 break
 
-            parts = filename.split('_')
-            if len(parts) == 4 and parts[-1].endswith(".npz"):
-                # Process cyphertext
-                part1 = int(parts[1], 16)
-                part1 = (part1 & 0xffffffffffffff00) | ((part1 & 0xff) ^ 0xc)
-                part3 = int(parts[3].split('.')[0], 16)
-                cypher = part1.to_bytes(8, 'big') + part3.to_bytes(8, 'big')
-
+            cypher = parse_cyphertext(filename)
+            if cypher is not None:
                 # Load trace data
                 with np.load(os.path.join(folder_path, filename)) as npz_file:
                     trace_data = npz_file['data'][start:start+nb_points]
@@ -70,6 +147,169 @@ def load_npz_traces(nb_traces, folder_path, start, nb_points, average=1, skip=Fa
     # Convert to numpy arrays for consistency
     return cyphertexts, np.array(data_arrays[:nb_traces])
 
+#--------------------------------------------------------------
+# A trace store is a folder holding the traces of a campaign as
+# .npy files, so that they can be memory-mapped instead of parsing
+# thousands of .npz files:
+#      - traces.npy      = (nb_traces, nb_points) float32
+#      - cyphertexts.npy = (nb_traces, 16) uint8
+#      - window.npy      = (start, nb_points) of the stored samples in
+#                          the original traces
+#
+# The stores built before window.npy existed are read as starting
+# at sample 0.
+#--------------------------------------------------------------
+def is_trace_store(path):
+    return os.path.isfile(os.path.join(path, "traces.npy"))
+
+def build_trace_store(folder_path, store_path, start, nb_points):
+    filenames = list_npz_traces(folder_path)
+    os.makedirs(store_path, exist_ok=True)
+
+    traces = np.lib.format.open_memmap(os.path.join(store_path, "traces.npy"), mode='w+',
+                                       dtype=np.float32, shape=(len(filenames), nb_points))
+    cyphertexts = np.zeros((len(filenames), 16), dtype=np.uint8)
+
+    with Bar('Building trace store', max=len(filenames)) as bar:
+        for i, filename in enumerate(filenames):
+            cyphertexts[i] = np.frombuffer(parse_cyphertext(filename), dtype=np.uint8)
+            with np.load(os.path.join(folder_path, filename)) as npz_file:
+                traces[i] = npz_file['data'][start:start+nb_points]
+            bar.next()
+        bar.finish()
+
+    traces.flush()
+    np.save(os.path.join(store_path, "cyphertexts.npy"), cyphertexts)
+    np.save(os.path.join(store_path, "window.npy"), np.array([start, nb_points]))
+
+def open_trace_store(store_path):
+    traces = np.load(os.path.join(store_path, "traces.npy"), mmap_mode='r')
+    cyphertexts = np.load(os.path.join(store_path, "cyphertexts.npy"))
+    return cyphertexts, traces
+
+# First sample of the store in the original traces
+def trace_store_start(store_path):
+    window_path = os.path.join(store_path, "window.npy")
+    if not os.path.isfile(window_path):
+        return 0
+    return int(np.load(window_path)[0])
+
+#--------------------------------------------------------------
+# Same interface as load_npz_traces, but from a trace store. Only
+# the selected traces are read from disk.
+#
+# start is a sample of the original traces (as for load_npz_traces),
+# not an offset in the store.
+#--------------------------------------------------------------
+def load_trace_store(nb_traces, store_path, start, nb_points, seed=None, indices=None):
+    cyphertexts, traces = open_trace_store(store_path)
+
+    store_start = trace_store_start(store_path)
+    if not store_start <= start < store_start + traces.shape[1]:
+        raise ValueError(f"Sample {start} is not in the store (samples {store_start} to {store_start + traces.shape[1] - 1})")
+    start -= store_start
+
+    if indices is None:
+        indices = select_traces(nb_traces, len(traces), seed)
+    indices = np.asarray(indices)
+
+    # Read the rows in file order, then put them back in the requested order
+    order = np.argsort(indices)
+    selected = np.empty((len(indices), min(nb_points, traces.shape[1] - start)), dtype=traces.dtype)
+    selected[order] = traces[indices[order], start:start+nb_points]
+
+    return [c.tobytes() for c in cyphertexts[indices]], selected
+
+#--------------------------------------------------------------
+# Multiresolution pyramid of a trace store, in <store>/pyramid:
+#      - level_1.npy  = the traces
+#      - level_N.npy  = the average of each bin of N samples
+#
+# If an alignment window (start, end) is given, the traces are
+# aligned (reference = average of the first 200 traces) before
+# being binned, and level_1 holds the aligned traces.
+#
+# level_1 is always built, the coarse-to-fine CPA reads the leakage
+# windows from it. Rebuilding a pyramid removes the previous levels.
+#
+# build.json records how the pyramid was built (factors, alignment
+# window, size and date of the store's traces.npy), it is written
+# last so that an interrupted build is never used.
+#--------------------------------------------------------------
+def pyramid_path(store_path):
+    return os.path.join(store_path, "pyramid")
+
+def pyramid_build_info(store_path, factors, align_start, align_end):
+    traces_path = os.path.join(store_path, "traces.npy")
+    num_traces, num_samples = np.load(traces_path, mmap_mode='r').shape
+    return {
+        "factors"      : sorted(set(factors) | {1}),
+        "align_window" : None if align_start is None else [align_start, align_end],
+        "num_traces"   : num_traces,
+        "num_samples"  : num_samples,
+        "store_mtime"  : os.path.getmtime(traces_path),
+    }
+
+def build_trace_pyramid(store_path, factors=(1, 4, 16), align_start=None, align_end=None, chunk_size=1000):
+    cyphertexts, traces = open_trace_store(store_path)
+    num_traces, num_samples = traces.shape
+    os.makedirs(pyramid_path(store_path), exist_ok=True)
+
+    for filename in os.listdir(pyramid_path(store_path)):
+        if filename == "build.json" or (filename.startswith("level_") and filename.endswith(".npy")):
+            os.remove(os.path.join(pyramid_path(store_path), filename))
+
+    factors = sorted(set(factors) | {1})
+    levels = {f: np.lib.format.open_memmap(os.path.join(pyramid_path(store_path), f"level_{f}.npy"), mode='w+',
+                                           dtype=np.float32, shape=(num_traces, num_samples // f)) for f in factors}
+
+    if align_start is not None:
+        reference = average_trace(traces[:200], align_start, align_end)
+
+    with Bar('Building trace pyramid', max=num_traces) as bar:
+        for i in range(0, num_traces, chunk_size):
+            chunk = np.asarray(traces[i:i+chunk_size])
+            if align_start is not None:
+                chunk = align_traces_piecewise([reference], chunk, [(align_start, align_end)])[0]
+
+            for f, level in levels.items():
+                width = num_samples // f
+                level[i:i+chunk_size] = chunk[:, :width*f].reshape(len(chunk), width, f).mean(axis=2)
+
+            bar.next(len(chunk))
+        bar.finish()
+
+    for level in levels.values():
+        level.flush()
+
+    with open(os.path.join(pyramid_path(store_path), "build.json"), "w") as f:
+        json.dump(pyramid_build_info(store_path, factors, align_start, align_end), f, indent=2)
+
+#--------------------------------------------------------------
+# True if the pyramid of the store holds the given factors and was
+# built with this alignment window from the current store
+#--------------------------------------------------------------
+def trace_pyramid_matches(store_path, factors, align_start=None, align_end=None):
+    build_path = os.path.join(pyramid_path(store_path), "build.json")
+    if not os.path.isfile(build_path):
+        return False
+
+    with open(build_path) as f:
+        built = json.load(f)
+    expected = pyramid_build_info(store_path, factors, align_start, align_end)
+
+    return (set(expected["factors"]) <= set(built["factors"]) and
+            all(built[key] == expected[key] for key in ["align_window", "num_traces", "num_samples", "store_mtime"]))
+
+# Return the levels of the pyramid as a dictionary factor -> memory-mapped traces
+def open_trace_pyramid(store_path):
+    levels = {}
+    for filename in os.listdir(pyramid_path(store_path)):
+        if filename.startswith("level_") and filename.endswith(".npy"):
+            factor = int(filename[len("level_"):-len(".npy")])
+            levels[factor] = np.load(os.path.join(pyramid_path(store_path), filename), mmap_mode='r')
+    return levels
+
 def align_trace(reference, trace, start, end):
     subtrace = trace[start:end]
     correlation = np.correlate(subtrace, reference, mode='full')
@@ -77,10 +317,145 @@ def align_trace(reference, trace, start, end):
     aligned_trace = np.roll(trace, -shift)
     return aligned_trace
 
+#--------------------------------------------------------------
+# Same as align_trace on a set of traces, but also return what the
+# cross-correlation tells about the quality of each alignment. The
+# shift is the same as align_trace, the quality metrics come from the
+# cross-correlation of the mean-removed window and reference, so that
+# a DC offset of the capture does not hide the peak:
+#
+# peaks : normalized cross-correlation at the applied shift
+# ratios: peak height over the highest value found outside
+#         +/- guard samples around the peak
+# shifts: applied shift
+#--------------------------------------------------------------
+def align_traces(reference, traces, start, end, guard=5):
+    num_traces = len(traces)
+    aligned_traces = np.empty_like(traces)
+    peaks = np.zeros(num_traces)
+    ratios = np.zeros(num_traces)
+    shifts = np.zeros(num_traces, dtype=int)
+
+    centered_ref = reference - np.mean(reference)
+    ref_norm = np.linalg.norm(centered_ref)
+
+    for i, trace in enumerate(traces):
+        subtrace = trace[start:end]
+        correlation = np.correlate(subtrace, reference, mode='full')
+        best = np.argmax(correlation)
+        shifts[i] = best - (len(subtrace) - 1)
+        aligned_traces[i] = np.roll(trace, -shifts[i])
+
+        # Normalized cross-correlation, for the quality metrics
+        centered = subtrace - np.mean(subtrace)
+        ncc = np.correlate(centered, centered_ref, mode='full') / (np.linalg.norm(centered) * ref_norm + 1e-10)
+        peaks[i] = ncc[best]
+
+        # Look for the second peak away from the main one
+        outside = ncc.copy()
+        outside[max(best - guard, 0):best + guard + 1] = -np.inf
+        second = np.max(outside)
+        ratios[i] = ncc[best] / second if second > 0 else np.inf
+
+    return aligned_traces, peaks, ratios, shifts
+
+# Robust z-score, based on the median and the median absolute deviation
+def robust_zscore(values):
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    return 0.6745 * (values - median) / (mad + 1e-10)
+
+#--------------------------------------------------------------
+# Flag bad traces using the output of align_traces and per-trace
+# robust statistics:
+#
+# weak_peak    : correlation peak is an outlier on the low side
+# ambiguous    : peak is not min_ratio times above the second peak
+# large_shift  : absolute shift is above max_shift
+# glitch       : largest deviation from the mean trace is an outlier
+#
+# max_z      : robust z-score above which a value is an outlier
+# downweight : weight given to a flagged trace (0 = drop it)
+#
+# Return the weight of each trace and the number of traces flagged
+# for each reason (a trace can be flagged for several reasons)
+#--------------------------------------------------------------
+def screen_traces(traces, peaks, ratios, shifts, max_shift=None, min_ratio=1.05, max_z=5.0, downweight=0.0, chunk_size=1000):
+    num_traces = len(traces)
+
+    # Largest deviation of each trace from the mean trace, computed by
+    # chunks to avoid a temporary copy of the whole set
+    mean_trace = np.mean(traces, axis=0, dtype=np.float64)
+    deviation = np.empty(num_traces)
+    for i in range(0, num_traces, chunk_size):
+        deviation[i:i+chunk_size] = np.max(np.abs(traces[i:i+chunk_size] - mean_trace), axis=1)
+
+    flags = {
+        "weak_peak"   : robust_zscore(peaks) < -max_z,
+        "ambiguous"   : ratios < min_ratio,
+        "large_shift" : np.abs(shifts) > max_shift if max_shift is not None else np.zeros(num_traces, dtype=bool),
+        "glitch"      : robust_zscore(deviation) > max_z,
+    }
+
+    flagged = np.logical_or.reduce(list(flags.values()))
+    weights = np.where(flagged, downweight, 1.0)
+
+    return weights, {reason: int(np.count_nonzero(mask)) for reason, mask in flags.items()}
+
 def average_trace(traces, start, end):
     sliced_traces = traces[:, start:end]
     return np.mean(sliced_traces, axis=0)
 
+# Shift of each trace in each window (start, end), against the
+# reference of the window. Return a (num_traces, num_windows) array
+def window_shifts(references, traces, windows):
+    shifts = np.zeros((len(traces), len(windows)), dtype=int)
+
+    for w, ((start, end), reference) in enumerate(zip(windows, references)):
+        # Same as np.correlate(subtrace, reference, mode='full') for
+        # all the traces at once, computed with FFTs
+        length = end - start
+        size = 2 * length - 1
+        subtraces = np.asarray(traces[:, start:end], dtype=np.float64)
+        spectrum = np.fft.rfft(subtraces, size, axis=1) * np.fft.rfft(reference[::-1], size)
+        correlation = np.fft.irfft(spectrum, size, axis=1)
+        shifts[:, w] = np.argmax(correlation, axis=1) - (length - 1)
+
+    return shifts
+
+#--------------------------------------------------------------
+# Piecewise alignment, for long traces where the jitter accumulates:
+# each window (start, end) has its own reference, and the segment of
+# the trace around a window is shifted by the offset found for that
+# window.
+#
+# references: one reference per window (see average_trace)
+# windows   : list of (start, end), sorted
+# boundaries: first sample of each segment but the first one. By
+#             default, segments change halfway between two windows.
+#
+# Return the aligned traces and the (num_traces, num_windows) shifts
+#--------------------------------------------------------------
+def align_traces_piecewise(references, traces, windows, boundaries=None, chunk_size=1000):
+    num_traces, num_samples = traces.shape
+
+    if boundaries is None:
+        boundaries = [(windows[w][1] + windows[w+1][0]) // 2 for w in range(len(windows) - 1)]
+    edges = [0] + list(boundaries) + [num_samples]
+
+    shifts = window_shifts(references, traces, windows)
+
+    aligned_traces = np.empty_like(traces)
+    rows = np.arange(num_traces)[:, None]
+    for w in range(len(windows)):
+        # Same as np.roll(trace, -shift) on the samples of the segment
+        samples = np.arange(edges[w], edges[w+1])
+        for i in range(0, num_traces, chunk_size):
+            index = (samples[None, :] + shifts[i:i+chunk_size, w][:, None]) % num_samples
+            aligned_traces[i:i+chunk_size, edges[w]:edges[w+1]] = traces[rows[i:i+chunk_size], index]
+
+    return aligned_traces, shifts
+
 def hw(data):
     HW = [bin(n).count("1") for n in range(0,256)]
     return HW[data]
@@ -156,9 +531,16 @@ t_table_decrypt = [
 def hw_t_table_decrypt():
     return [hw(t_table_decrypt[i*4]) + hw(t_table_decrypt[(i*4)+1]) + hw(t_table_decrypt[(i*4)+2]) + hw(t_table_decrypt[(i*4)+3]) for i in range(256)]
 
-def compute_coeff(key_byte_number, kguess, plaintext, leakage_model, traces):
+#--------------------------------------------------------------
+# weights: optional weight of each trace (e.g. the group sizes
+#          returned by group_by_cyphertext)
+#--------------------------------------------------------------
+def compute_coeff(key_byte_number, kguess, plaintext, leakage_model, traces, weights=None):
     num_traces, num_samples = traces.shape
 
+    if weights is None:
+        weights = np.ones(num_traces)
+
     sumnum = np.zeros(num_samples)
     sumden1 = np.zeros(num_samples)
     sumden2 = np.zeros(num_samples)
@@ -169,27 +551,30 @@ def compute_coeff(key_byte_number, kguess, plaintext, leakage_model, traces):
         hyp[tnum] = leakage_model(plaintext[tnum][key_byte_number], kguess)
 
     #Mean of hypothesis
-    meanh = np.mean(hyp, dtype=np.float64)
+    meanh = np.average(hyp, weights=weights)
 
     #Mean of all points in trace
-    meant = np.mean(traces, axis=0, dtype=np.float64)
+    meant = np.average(traces, axis=0, weights=weights)
 
     #For each trace, do the following
     for tnum in range(0, num_traces):
         hdiff = (hyp[tnum] - meanh)
         tdiff = traces[tnum,:] - meant
-        sumnum = sumnum + (hdiff*tdiff)
-        sumden1 = sumden1 + hdiff*hdiff
-        sumden2 = sumden2 + tdiff*tdiff
+        sumnum = sumnum + weights[tnum]*(hdiff*tdiff)
+        sumden1 = sumden1 + weights[tnum]*hdiff*hdiff
+        sumden2 = sumden2 + weights[tnum]*tdiff*tdiff
 
     correlation_plot = sumnum / np.sqrt(sumden1*sumden2+ 1e-10)
     highest_coeff = max(abs(correlation_plot))
 
     return correlation_plot, highest_coeff
 
-def compute_coeff_with_convergence(key_byte_number, kguess, plaintext, leakage_model, traces):
+def compute_coeff_with_convergence(key_byte_number, kguess, plaintext, leakage_model, traces, weights=None):
     num_traces, num_samples = traces.shape
 
+    if weights is None:
+        weights = np.ones(num_traces)
+
     cpa_evol = []
     sumnum = np.zeros(num_samples)
     sumden1 = np.zeros(num_samples)
@@ -201,20 +586,461 @@ def compute_coeff_with_convergence(key_byte_number, kguess, plaintext, leakage_m
         hyp[tnum] = leakage_model(plaintext[tnum][key_byte_number], kguess)
 
         #Mean of hypothesis
-        meanh = np.mean(hyp[:tnum + 1], dtype=np.float64)
+        meanh = np.average(hyp[:tnum + 1], weights=weights[:tnum + 1])
 
         #Mean of all points in trace
-        meant = np.mean(traces[:tnum + 1], axis=0, dtype=np.float64)
+        meant = np.average(traces[:tnum + 1], axis=0, weights=weights[:tnum + 1])
 
         #For each trace, do the following
         hdiff = (hyp[tnum] - meanh)
         tdiff = traces[tnum,:] - meant
-        sumnum = sumnum + (hdiff*tdiff)
-        sumden1 = sumden1 + hdiff*hdiff
-        sumden2 = sumden2 + tdiff*tdiff
+        sumnum = sumnum + weights[tnum]*(hdiff*tdiff)
+        sumden1 = sumden1 + weights[tnum]*hdiff*hdiff
+        sumden2 = sumden2 + weights[tnum]*tdiff*tdiff
 
         correlation_plot = sumnum / np.sqrt(sumden1*sumden2+ 1e-10)
         highest_coeff = max(abs(correlation_plot))
         cpa_evol.append(highest_coeff)
 
-    return correlation_plot, highest_coeff, np.array(cpa_evol)
\ No newline at end of file
+    return correlation_plot, highest_coeff, np.array(cpa_evol)
+
+#--------------------------------------------------------------
+# Vectorized CPA: the 256 guesses of a key byte are computed at
+# once, from sums accumulated over blocks of traces:
+#
+# acc = cpa_init(num_samples)
+# cpa_update(acc, hyp, traces)   # as many times as needed
+# correlation = cpa_correlation(acc)
+#
+# hyp is the (num_traces, num_guesses) matrix of the leakage model
+# for each trace and guess (see cpa_hypotheses)
+#
+# The samples are independent, so the sample axis is split in tiles
+# of tile_size samples, processed by 'workers' threads. numpy
+# releases the GIL in these operations. If numpy is linked with a
+# multithreaded BLAS, limit its threads (e.g. OPENBLAS_NUM_THREADS=1)
+# when using several workers (the scripts use 1 worker by default).
+#--------------------------------------------------------------
+def cpa_hypotheses(key_byte_number, plaintext, model_table, guesses=None):
+    if guesses is None:
+        guesses = np.arange(256)
+    data = np.frombuffer(b"".join(plaintext), dtype=np.uint8).reshape(-1, 16)[:, key_byte_number]
+    return np.asarray(model_table, dtype=np.float64)[data[:, None] ^ np.asarray(guesses)[None, :]]
+
+# Thread pools shared by all the accumulators, by number of workers
+thread_pools = {}
+
+def thread_pool(workers):
+    if workers not in thread_pools:
+        thread_pools[workers] = ThreadPoolExecutor(max_workers=workers)
+    return thread_pools[workers]
+
+def cpa_init(num_samples, num_guesses=256, workers=1, tile_size=4096):
+    return {
+        "n"       : 0.0,
+        "sum_h"   : np.zeros(num_guesses),
+        "sum_h2"  : np.zeros(num_guesses),
+        "sum_t"   : np.zeros(num_samples),
+        "sum_t2"  : np.zeros(num_samples),
+        "sum_ht"  : np.zeros((num_guesses, num_samples)),
+        "workers" : workers,
+        "tiles"   : [slice(s, min(s + tile_size, num_samples)) for s in range(0, num_samples, tile_size)],
+    }
+
+# Call function(tile) for each tile of samples of the accumulator
+def for_each_tile(acc, function):
+    if acc["workers"] <= 1 or len(acc["tiles"]) == 1:
+        for tile in acc["tiles"]:
+            function(tile)
+    else:
+        # Tiles are disjoint, so the threads never write the same data
+        for _ in thread_pool(acc["workers"]).map(function, acc["tiles"]):
+            pass
+
+def cpa_update(acc, hyp, traces, weights=None):
+    if weights is None:
+        weights = np.ones(len(traces))
+
+    weighted_hyp = hyp * weights[:, None]
+
+    acc["n"] += np.sum(weights)
+    acc["sum_h"] += np.sum(weighted_hyp, axis=0)
+    acc["sum_h2"] += np.sum(weighted_hyp * hyp, axis=0)
+
+    def update_tile(tile):
+        t = np.asarray(traces[:, tile], dtype=np.float64)
+        acc["sum_t"][tile] += weights @ t
+        acc["sum_t2"][tile] += weights @ (t * t)
+        acc["sum_ht"][:, tile] += weighted_hyp.T @ t
+
+    for_each_tile(acc, update_tile)
+
+def cpa_correlation(acc):
+    n = acc["n"]
+    den_h = n * acc["sum_h2"] - acc["sum_h"] ** 2
+    correlation = np.empty_like(acc["sum_ht"])
+
+    def correlation_tile(tile):
+        num = n * acc["sum_ht"][:, tile] - np.outer(acc["sum_h"], acc["sum_t"][tile])
+        den_t = n * acc["sum_t2"][tile] - acc["sum_t"][tile] ** 2
+        correlation[:, tile] = num / np.sqrt(np.outer(den_h, den_t) + 1e-10)
+
+    for_each_tile(acc, correlation_tile)
+    return correlation
+
+#--------------------------------------------------------------
+# Same result as calling compute_coeff for the 256 guesses.
+# model_table is the leakage model as a table indexed by
+# cyphertext_byte ^ keyguess (e.g. hw_t_table_decrypt())
+#
+# Return the (256, num_samples) correlation and the highest
+# absolute coefficient of each guess
+#--------------------------------------------------------------
+def compute_coeff_all(key_byte_number, plaintext, model_table, traces, weights=None, chunk_size=1000, workers=1, tile_size=4096):
+    num_traces, num_samples = traces.shape
+    acc = cpa_init(num_samples, workers=workers, tile_size=tile_size)
+
+    for i in range(0, num_traces, chunk_size):
+        hyp = cpa_hypotheses(key_byte_number, plaintext[i:i+chunk_size], model_table)
+        cpa_update(acc, hyp, traces[i:i+chunk_size], None if weights is None else weights[i:i+chunk_size])
+
+    correlation = cpa_correlation(acc)
+    return correlation, np.max(np.abs(correlation), axis=1)
+
+#--------------------------------------------------------------
+# Yield the number of traces used and the highest absolute
+# coefficient of the guesses (default: all) every 'step' traces
+#--------------------------------------------------------------
+def iter_convergence(key_byte_number, plaintext, model_table, traces, step=100, weights=None, guesses=None, workers=1, tile_size=4096):
+    num_traces, num_samples = traces.shape
+    num_guesses = 256 if guesses is None else len(guesses)
+    acc = cpa_init(num_samples, num_guesses, workers, tile_size)
+
+    for i in range(0, num_traces, step):
+        hyp = cpa_hypotheses(key_byte_number, plaintext[i:i+step], model_table, guesses)
+        cpa_update(acc, hyp, traces[i:i+step], None if weights is None else weights[i:i+step])
+        yield min(i + step, num_traces), np.max(np.abs(cpa_correlation(acc)), axis=1)
+
+#--------------------------------------------------------------
+# Return the number of traces at each checkpoint and the
+# (nb_checkpoints, nb_guesses) evolution of the highest coefficients
+#--------------------------------------------------------------
+def compute_coeff_all_with_convergence(key_byte_number, plaintext, model_table, traces, step=100, weights=None, guesses=None, workers=1, tile_size=4096):
+    checkpoints = []
+    cpa_evol = []
+    for count, maxcpa in iter_convergence(key_byte_number, plaintext, model_table, traces, step, weights, guesses, workers, tile_size):
+        checkpoints.append(count)
+        cpa_evol.append(maxcpa)
+
+    return np.array(checkpoints), np.array(cpa_evol)
+
+#--------------------------------------------------------------
+# Summary of a checkpoint for a known key byte:
+#
+# rank       : number of guesses with a higher coefficient (0 = found)
+# margin     : coefficient of the known key byte minus the one of the
+#              best wrong guess (> 0 when found)
+# known_coeff: coefficient of the known key byte
+# best_guess : guess with the highest coefficient
+# best_coeff : coefficient of the best guess
+#--------------------------------------------------------------
+CONVERGENCE_FIELDS = ["bnum", "traces", "rank", "margin", "known_coeff", "best_guess", "best_coeff"]
+
+def convergence_record(bnum, count, maxcpa, known_key_byte):
+    known_coeff = maxcpa[known_key_byte]
+    best_guess = int(np.argmax(maxcpa))
+    return {
+        "bnum"        : bnum,
+        "traces"      : count,
+        "rank"        : int(np.count_nonzero(maxcpa > known_coeff)),
+        "margin"      : float(known_coeff - np.max(np.delete(maxcpa, known_key_byte))),
+        "known_coeff" : float(known_coeff),
+        "best_guess"  : best_guess,
+        "best_coeff"  : float(maxcpa[best_guess]),
+    }
+
+#--------------------------------------------------------------
+# Follow the convergence of several key bytes and write one CSV row
+# per byte and checkpoint to output_path while the attack runs. Only
+# the sums of one key byte are in memory at a time.
+#
+# known_key: 16 bytes of the known key
+#
+# Return the records of the last checkpoint of each byte
+#--------------------------------------------------------------
+def track_convergence(output_path, plaintext, model_table, traces, known_key, key_bytes=range(16), step=100, weights=None, workers=1, tile_size=4096):
+    last = {}
+
+    with open(output_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CONVERGENCE_FIELDS)
+        writer.writeheader()
+
+        with Bar('Tracking convergence', max=len(key_bytes) * -(-len(traces) // step)) as bar:
+            for bnum in key_bytes:
+                for count, maxcpa in iter_convergence(bnum, plaintext, model_table, traces, step, weights, workers=workers, tile_size=tile_size):
+                    last[bnum] = convergence_record(bnum, count, maxcpa, known_key[bnum])
+                    writer.writerow(last[bnum])
+                    f.flush()
+                    bar.next()
+            bar.finish()
+
+    return last
+
+def read_convergence(path):
+    with open(path, newline="") as f:
+        return [{k: float(v) if k in ("margin", "known_coeff", "best_coeff") else int(v) for k, v in row.items()}
+                for row in csv.DictReader(f)]
+
+#--------------------------------------------------------------
+# Second-order CPA, for implementations where the T-table lookup is
+# masked. Two samples (i, j) of each trace are combined, after
+# centering, and the combined value is correlated with the model:
+#
+# product : (t[i] - mean[i]) * (t[j] - mean[j])
+# absdiff : |(t[i] - mean[i]) - (t[j] - mean[j])|
+#
+# The pairs are taken inside the given windows: for a single window
+# all the pairs i < j of the window, and for several windows also
+# all the pairs with i and j in two different windows. A list of
+# points of interest (pois) can be given instead, in which case all
+# the pairs of these samples are used. The windows must not overlap
+# (a pair would be used twice), duplicated pois are ignored.
+#
+# The number of pairs grows quadratically, so the pairs are
+# generated by blocks, and each block is combined and correlated by
+# chunks of traces. Blocks are processed by a pool of threads (numpy
+# releases the GIL in the heavy operations).
+#--------------------------------------------------------------
+def pair_groups(windows=None, pois=None):
+    if pois is not None:
+        return [np.unique(pois)]
+
+    ordered = sorted(windows)
+    for (_, end), (start, _) in zip(ordered, ordered[1:]):
+        if start < end:
+            raise ValueError(f"Windows {ordered} overlap")
+    return [np.arange(start, end) for start, end in windows]
+
+def iter_pair_blocks(block_size, windows=None, pois=None):
+    groups = pair_groups(windows, pois)
+
+    # Same group: pairs i < j. Different groups: all the pairs.
+    for a in range(len(groups)):
+        for b in range(a, len(groups)):
+            first, second = groups[a], groups[b]
+            total = len(first) * len(second)
+            for k in range(0, total, block_size):
+                index = np.arange(k, min(k + block_size, total))
+                i = first[index // len(second)]
+                j = second[index % len(second)]
+                if a == b:
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                if len(i) > 0:
+                    yield i, j
+
+def combine_samples(centered, i, j, mode="product"):
+    if mode == "product":
+        return centered[:, i] * centered[:, j]
+    if mode == "absdiff":
+        return np.abs(centered[:, i] - centered[:, j])
+    raise ValueError(f"Unknown combination mode '{mode}'")
+
+# Number of pairs per block so that the workers stay in the memory
+# budget, once 'shared_bytes' (the centered samples) are allocated
+def pair_block_size(memory_mb, workers, chunk_size, num_guesses=256, shared_bytes=0):
+    # Per pair: the two samples, their combination and its square for a
+    # chunk of traces, the accumulated sums and, per guess, sum_ht, the
+    # update product and the correlation with its temporaries
+    bytes_per_pair = 8 * (4 * chunk_size + 8 * num_guesses + 4)
+    block_size = int((memory_mb * 1024 * 1024 - shared_bytes) / (workers * bytes_per_pair))
+    if block_size < 1:
+        required = (shared_bytes + workers * bytes_per_pair) / (1024 * 1024)
+        raise ValueError(f"Memory budget of {memory_mb} MB is too small, at least {required:.0f} MB are required")
+    return block_size
+
+#--------------------------------------------------------------
+# Like executor.map, but only 'pending' tasks are submitted at a
+# time, so that the inputs (and results) are not all in memory
+#--------------------------------------------------------------
+def map_bounded(executor, function, iterable, pending):
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(function, item))
+        if len(futures) >= pending:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+#--------------------------------------------------------------
+# Return the highest absolute coefficient of each guess and the
+# pair of samples (i, j) where it was found
+#--------------------------------------------------------------
+def compute_coeff_second_order(key_byte_number, plaintext, model_table, traces, windows=None, pois=None,
+                               mode="product", weights=None, chunk_size=1000, memory_mb=1024, workers=None):
+    num_traces = len(traces)
+    workers = workers or os.cpu_count()
+
+    hyp = cpa_hypotheses(key_byte_number, plaintext, model_table)
+
+    # Only the samples used by the pairs are centered, once for all the blocks
+    columns = np.unique(np.concatenate(pair_groups(windows, pois)))
+    centered = np.empty((num_traces, len(columns)), dtype=np.float64)
+    for t in range(0, num_traces, chunk_size):
+        centered[t:t+chunk_size] = traces[t:t+chunk_size, columns]
+    centered -= np.mean(centered, axis=0)
+
+    def process_block(pairs):
+        i, j = pairs
+        ci, cj = np.searchsorted(columns, i), np.searchsorted(columns, j)
+        acc = cpa_init(len(i), hyp.shape[1])
+        for t in range(0, num_traces, chunk_size):
+            combined = combine_samples(centered[t:t+chunk_size], ci, cj, mode)
+            cpa_update(acc, hyp[t:t+chunk_size], combined, None if weights is None else weights[t:t+chunk_size])
+
+        correlation = np.abs(cpa_correlation(acc))
+        best = np.argmax(correlation, axis=1)
+        return correlation[np.arange(len(best)), best], i[best], j[best]
+
+    maxcpa = np.zeros(hyp.shape[1])
+    best_pairs = np.zeros((hyp.shape[1], 2), dtype=int)
+
+    block_size = pair_block_size(memory_mb, workers, chunk_size, hyp.shape[1], centered.nbytes)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for coeff, i, j in map_bounded(executor, process_block, iter_pair_blocks(block_size, windows, pois), workers):
+            better = coeff > maxcpa
+            maxcpa[better] = coeff[better]
+            best_pairs[better, 0] = i[better]
+            best_pairs[better, 1] = j[better]
+
+    return maxcpa, best_pairs
+
+#--------------------------------------------------------------
+# Linear regression attack (stochastic model). Instead of assuming
+# that each bit of the T-table output leaks the same (hamming
+# weight), the leakage of each sample is fitted for each guess as a
+# linear combination of a basis of the T-table entry:
+#
+# t_table  : constant + the 32 bits of the T-table output
+# hw_bytes : constant + the hamming weight of the 4 bytes of the
+#            T-table output
+#
+# (A basis made of the 8 bits of the T-table input would give the
+# same fit for all guesses, the xor with the key only flips the sign
+# of the coefficients.)
+#
+# The basis only depends on the 256 values of cyphertext ^ keyguess,
+# so the normal matrices X'X and X'T of all guesses are built from
+# the per-value number of traces and sum of traces, and all the
+# least-squares problems are solved at once.
+#--------------------------------------------------------------
+def t_table_bits_decrypt():
+    entries = np.array(t_table_decrypt, dtype=np.uint8).reshape(256, 4)
+    return np.unpackbits(entries, axis=1)
+
+def lra_basis(basis="t_table"):
+    if basis == "t_table":
+        columns = t_table_bits_decrypt()
+    elif basis == "hw_bytes":
+        columns = np.unpackbits(np.array(t_table_decrypt, dtype=np.uint8).reshape(256, 4, 1), axis=2).sum(axis=2)
+    else:
+        raise ValueError(f"Unknown basis '{basis}'")
+    return np.hstack((np.ones((256, 1)), columns)).astype(np.float64)
+
+#--------------------------------------------------------------
+# Return the coefficient of determination R^2 of the fit for each
+# guess and sample (256, num_samples), and the highest R^2 of each
+# guess
+#--------------------------------------------------------------
+def compute_lra(key_byte_number, plaintext, traces, basis="t_table", weights=None, chunk_size=1000, tile_size=2000):
+    num_traces, num_samples = traces.shape
+    if weights is None:
+        weights = np.ones(num_traces)
+
+    data = np.frombuffer(b"".join(plaintext), dtype=np.uint8).reshape(-1, 16)[:, key_byte_number]
+
+    # Number of traces and sum of traces for each value of the cyphertext byte
+    count = np.bincount(data, weights=weights, minlength=256)
+    sum_by_value = np.zeros((256, num_samples))
+    sum_t = np.zeros(num_samples)
+    sum_t2 = np.zeros(num_samples)
+    for i in range(0, num_traces, chunk_size):
+        chunk = np.asarray(traces[i:i+chunk_size], dtype=np.float64)
+        w = weights[i:i+chunk_size]
+        onehot = np.zeros((len(chunk), 256))
+        onehot[np.arange(len(chunk)), data[i:i+chunk_size]] = w
+        sum_by_value += onehot.T @ chunk
+        sum_t += w @ chunk
+        sum_t2 += w @ (chunk * chunk)
+
+    X = lra_basis(basis)
+    num_terms = X.shape[1]
+
+    # For guess g the trace with cyphertext byte c uses the row c ^ g of the basis
+    permutation = np.arange(256)[None, :] ^ np.arange(256)[:, None]
+    X_by_guess = X[permutation]                                     # (guess, value, term)
+
+    # Normal matrices X'X of every guess, and their (pseudo) inverse
+    normal = np.einsum('gv,gvk,gvl->gkl', np.broadcast_to(count, (256, 256)), X_by_guess, X_by_guess)
+    normal_inv = np.linalg.pinv(normal)
+
+    n = np.sum(weights)
+    total = sum_t2 - sum_t ** 2 / n
+
+    r2 = np.zeros((256, num_samples))
+    X_stacked = X_by_guess.transpose(0, 2, 1).reshape(256 * num_terms, 256)
+    for s in range(0, num_samples, tile_size):
+        # X'T of every guess for this tile of samples
+        xt = (X_stacked @ sum_by_value[:, s:s+tile_size]).reshape(256, num_terms, -1)
+        beta = normal_inv @ xt
+        explained = np.sum(beta * xt, axis=1)
+        r2[:, s:s+tile_size] = (explained - sum_t[s:s+tile_size] ** 2 / n) / (total[s:s+tile_size] + 1e-10)
+
+    return r2, np.max(r2, axis=1)
+
+#--------------------------------------------------------------
+# Coarse-to-fine CPA on a trace pyramid. The CPA is first run on
+# the coarse level (bins of 'factor' samples). The bins where the
+# best guess correlates more than the others bins (robust z-score
+# above 'threshold') are turned into windows of the full resolution
+# traces, enlarged by 'margin' samples, and the CPA is run again at
+# full resolution in these windows only.
+#
+# levels : pyramid levels, see open_trace_pyramid
+# indices: traces to use (rows of the levels)
+#
+# Return the windows and, for each guess, the highest absolute
+# coefficient found in the windows
+#--------------------------------------------------------------
+def select_windows(score, factor, num_samples, threshold=5.0, margin=16):
+    selected = np.nonzero(robust_zscore(score) > threshold)[0]
+    if len(selected) == 0:
+        selected = [np.argmax(score)]
+
+    windows = []
+    for b in selected:
+        start = max(int(b) * factor - margin, 0)
+        end = min((int(b) + 1) * factor + margin, num_samples)
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return windows
+
+def coarse_to_fine_cpa(key_byte_number, plaintext, model_table, levels, indices, factor, threshold=5.0, margin=16,
+                       workers=1, tile_size=4096):
+    indices = np.asarray(indices)
+    full = levels[1]
+    num_samples = full.shape[1]
+
+    coarse = np.asarray(levels[factor][indices])
+    correlation, _ = compute_coeff_all(key_byte_number, plaintext, model_table, coarse, workers=workers, tile_size=tile_size)
+    windows = select_windows(np.max(np.abs(correlation), axis=0), factor, num_samples, threshold, margin)
+
+    maxcpa = np.zeros(256)
+    for start, end in windows:
+        fine = np.asarray(full[indices, start:end])
+        _, window_max = compute_coeff_all(key_byte_number, plaintext, model_table, fine, workers=workers, tile_size=tile_size)
+        maxcpa = np.maximum(maxcpa, window_max)
+
+    return windows, maxcpa
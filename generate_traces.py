@@ -0,0 +1,20 @@
+import argparse
+import cpa_synth
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--traces", help="Path where the traces are written", required=True)
+parser.add_argument("--num", help="Number of traces to generate", type=int, default=20000)
+parser.add_argument("--count", help="Number of sample per trace", type=int, default=25000)
+parser.add_argument("--noise", help="Standard deviation of the noise", type=float, default=1.0)
+parser.add_argument("--leak", help="Amplitude of the leakage per bit of hamming weight", type=float, default=0.1)
+parser.add_argument("--jitter", help="Maximum random shift of a trace", type=int, default=5)
+parser.add_argument("--repeat", help="Number of consecutive traces with the same cyphertext", type=int, default=1)
+parser.add_argument("--key", help="Round 10 key (32 hex digits)", default=None)
+parser.add_argument("--seed", help="Seed of the random generator", type=int, default=0)
+args = parser.parse_args()
+
+key = bytes.fromhex(args.key) if args.key else None
+
+cyphertexts, traces = cpa_synth.generate_traces(args.num, key, args.count, noise=args.noise, leak=args.leak,
+                                                jitter=args.jitter, repeat=args.repeat, seed=args.seed)
+cpa_synth.write_npz_traces(args.traces, cyphertexts, traces)